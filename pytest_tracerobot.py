@@ -1,4 +1,18 @@
 import os
+import bisect
+import dis
+import fnmatch
+import heapq
+import inspect
+import json
+import mmap
+import re
+import reprlib
+import shutil
+import socket
+import sys
+import threading
+import time
 import traceback
 import tracerobot
 import logging
@@ -15,6 +29,244 @@ def common_items(iter1, iter2):
         common.append(first)
     return common
 
+def sidecar_path(output, suffix):
+    """ Return the path of a file stored next to the XML output. """
+    return os.path.splitext(output)[0] + suffix
+
+# Robot Framework escapes '<' in text content, so these can only match tags
+TEST_ELEMENT_RE = re.compile(rb"<test[\s>]|</test>")
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+def scan_test_elements(path):
+    """ Return (start, end) byte offsets of the test elements in a Robot
+    Framework XML output file, in file order. """
+    offsets = []
+    if os.path.getsize(path) == 0:
+        return offsets
+
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            start = None
+            for match in TEST_ELEMENT_RE.finditer(data):
+                if match.group().startswith(b"</"):
+                    offsets.append((start, match.end()))
+                else:
+                    start = match.start()
+    return offsets
+
+def read_test_index(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def write_test_index(path, output, tests):
+    """ tests is a list of (nodeid, start, end) tuples in file order. """
+    index = {
+        "output": os.path.basename(output),
+        "size": os.path.getsize(output),
+        "tests": [list(test) for test in tests]
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(index, f)
+
+def _copy_range(src, dst, start, end):
+    src.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        chunk = src.read(min(remaining, COPY_CHUNK_SIZE))
+        if not chunk:
+            break
+        dst.write(chunk)
+        remaining -= len(chunk)
+
+def splice_test_elements(target, target_tests, source, source_tests):
+    """ Replace test elements in the target output file by the elements
+    with the same nodeid in the source output file, in a single streaming
+    pass. Returns the updated test index of the target and the list of
+    source nodeids that did not exist in the target. """
+    replacements = {nodeid: (start, end) for nodeid, start, end in source_tests}
+    spliced = []
+    tmp_path = target + ".splice"
+
+    with open(target, "rb") as old, open(source, "rb") as new, \
+            open(tmp_path, "wb") as out:
+        pos = 0
+        for nodeid, start, end in target_tests:
+            _copy_range(old, out, pos, start)
+            new_start = out.tell()
+            if nodeid in replacements:
+                _copy_range(new, out, *replacements.pop(nodeid))
+            else:
+                _copy_range(old, out, start, end)
+            spliced.append((nodeid, new_start, out.tell()))
+            pos = end
+
+        old.seek(pos)
+        shutil.copyfileobj(old, out, COPY_CHUNK_SIZE)
+
+    os.replace(tmp_path, target)
+    missing = [nodeid for nodeid, _, _ in source_tests if nodeid in replacements]
+    return spliced, missing
+
+# Custom value summarizers, see register_value_summarizer()
+VALUE_SUMMARIZERS = {}
+
+def register_value_summarizer(cls, summarizer):
+    """ Use summarizer(value) instead of repr() when tracing values that are
+    instances of cls (or its subclasses). The summarizer should return a
+    short string, or None if the value should not be traced at all.
+
+    Typically called from conftest.py, e.g.
+        register_value_summarizer(pandas.DataFrame,
+            lambda df: "DataFrame %dx%d" % df.shape)
+    """
+    VALUE_SUMMARIZERS[cls] = summarizer
+
+class BoundedRepr(reprlib.Repr):
+    """ reprlib.Repr that also slices bytes objects before repr'ing them,
+    so that large blobs are never repr'd in full.
+
+    Other objects are repr'd in full and truncated afterwards, unless they
+    have a len() larger than maxitems, in which case only their type and
+    length are shown. Objects with an expensive repr but no len() need a
+    summarizer, see register_value_summarizer(). """
+
+    def __init__(self, maxlength, maxitems):
+        super(BoundedRepr, self).__init__()
+        self.maxstring = self.maxother = self.maxlong = maxlength
+        self.maxlist = self.maxtuple = self.maxdict = maxitems
+        self.maxset = self.maxfrozenset = self.maxdeque = maxitems
+        self.maxarray = maxitems
+
+    def repr_bytes(self, x, level):
+        if len(x) <= self.maxstring:
+            return repr(x)
+        # the result must fit in maxstring, or the size would be cut off
+        suffix = "... (%d bytes)" % len(x)
+        room = max(self.maxstring - len(suffix), 0)
+        return repr(x[:room])[:room] + suffix
+
+    repr_bytearray = repr_bytes
+
+    def repr_instance(self, x, level):
+        try:
+            size = len(x)
+        except Exception:
+            size = None
+        if size is not None and size > self.maxlist:
+            return "<%s of length %d>" % (type(x).__name__, size)
+        return super(BoundedRepr, self).repr_instance(x, level)
+
+class ValueCapturePolicy:
+    """ Decides how keyword return values are written to the trace. """
+
+    def __init__(self, maxlength, maxitems, enabled=True, summarizers=None):
+        self.enabled = enabled
+        self._repr = BoundedRepr(maxlength, maxitems)
+        self._maxlength = maxlength
+        if summarizers is None:
+            summarizers = VALUE_SUMMARIZERS
+        self._summarizers = summarizers
+
+    def _find_summarizer(self, value):
+        if self._summarizers:
+            for cls in type(value).__mro__:
+                summarizer = self._summarizers.get(cls)
+                if summarizer:
+                    return summarizer
+        return None
+
+    def capture(self, value):
+        """ Return a bounded string representation of value, or None if
+        the value should not be traced. """
+        if value is None or not self.enabled:
+            return None
+
+        summarizer = self._find_summarizer(value)
+        if summarizer:
+            try:
+                text = summarizer(value)
+            except Exception:
+                # tracing must never break the test
+                text = "<%s: summarizer failed>" % type(value).__name__
+        else:
+            text = self._repr.repr(value)
+
+        if text is not None and len(text) > self._maxlength:
+            text = text[:self._maxlength] + "..."
+        return text
+
+class TraceRobotResults:
+    """ Aggregate results of the traced tests, updated as tests finish.
+
+    Statuses follow the pytest outcome of the test: "passed", "failed" or
+    "skipped" (which includes xfailed tests), even though Robot Framework
+    output only knows PASS and FAIL. """
+
+    STATUSES = ("passed", "failed", "skipped")
+
+    # Upper bounds of the test duration histogram buckets, in seconds
+    DURATION_BUCKETS = (0.01, 0.1, 1.0, 10.0, 60.0)
+
+    def __init__(self, slowest_count=10):
+        self.passed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.elapsed = 0.0
+        self.tags = {}
+        self.durations = [0] * (len(self.DURATION_BUCKETS) + 1)
+        self._slowest = []
+        self._slowest_count = slowest_count
+
+    @property
+    def total(self):
+        return self.passed + self.failed + self.skipped
+
+    @property
+    def slowest(self):
+        """ List of (nodeid, elapsed) of the slowest tests, slowest first. """
+        return [(nodeid, elapsed)
+            for elapsed, nodeid in sorted(self._slowest, reverse=True)]
+
+    def add_test(self, nodeid, tags, status, elapsed):
+        assert status in self.STATUSES
+        setattr(self, status, getattr(self, status) + 1)
+        self.elapsed += elapsed
+
+        for tag in tags:
+            counts = self.tags.get(tag)
+            if counts is None:
+                counts = self.tags[tag] = dict.fromkeys(self.STATUSES, 0)
+            counts[status] += 1
+
+        self.durations[bisect.bisect_left(self.DURATION_BUCKETS, elapsed)] += 1
+
+        if len(self._slowest) < self._slowest_count:
+            heapq.heappush(self._slowest, (elapsed, nodeid))
+        elif self._slowest_count:
+            heapq.heappushpop(self._slowest, (elapsed, nodeid))
+
+    def as_dict(self):
+        bounds = [str(bound) for bound in self.DURATION_BUCKETS] + ["inf"]
+        return {
+            "total": self.total,
+            "passed": self.passed,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "elapsed": self.elapsed,
+            "tags": self.tags,
+            "durations": dict(zip(bounds, self.durations)),
+            "slowest": [{"nodeid": nodeid, "elapsed": elapsed}
+                for nodeid, elapsed in self.slowest]
+        }
+
+class TraceRobotHookSpecs:
+    """ Hooks provided by the plugin, to be implemented in conftest.py """
+
+    def pytest_tracerobot_results(self, config, results):
+        """ Called at the end of the session with the TraceRobotResults
+        of the run. """
+
 class TraceRobotPythonLogger(logging.Handler):
 
     LOG_LEVELS = {
@@ -25,31 +277,381 @@ class TraceRobotPythonLogger(logging.Handler):
         logging.DEBUG:      "DEBUG"
     }
 
-    def __init__(self):
+    def __init__(self, lock):
         super(TraceRobotPythonLogger, self).__init__()
+        self._trace_lock = lock
 
     def handle(self, record):
-        tracerobot.log_message(record.getMessage(), level=record.levelname)
+        with self._trace_lock:
+            tracerobot.log_message(record.getMessage(), level=record.levelname)
+
+class TraceRobotEventStream:
+    """ Publishes trace events as newline-delimited JSON to a Unix domain
+    socket. Each event is sent as a single datagram without blocking; if no
+    listener is bound to the socket, or the listener is not keeping up,
+    the event is dropped. """
+
+    def __init__(self, path):
+        self._path = path
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+        self.dropped = 0
+
+    def emit(self, event, **fields):
+        fields["event"] = event
+        fields["time"] = time.time()
+        data = json.dumps(fields, default=str) + "\n"
+        try:
+            self._sock.sendto(data.encode("utf-8"), self._path)
+        except OSError:
+            # no listener, or listener's receive buffer is full
+            self.dropped += 1
+
+    def close(self):
+        self._sock.close()
+
+class TraceRobotWatchdog(threading.Thread):
+    """ Waits for a test to finish and calls back if it takes longer than
+    the given timeout. """
+
+    def __init__(self, timeout, callback):
+        super(TraceRobotWatchdog, self).__init__(name="tracerobot-watchdog")
+        self.daemon = True
+        self._timeout = timeout
+        self._callback = callback
+        self._finished = threading.Event()
+
+    def run(self):
+        if not self._finished.wait(self._timeout):
+            self._callback()
+
+    def stop(self):
+        self._finished.set()
+        self.join()
+
+def format_thread_stacks():
+    """ Return a snapshot of the stacks of all running threads. """
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    current = threading.get_ident()
+    chunks = []
+    for ident, frame in sys._current_frames().items():
+        if ident == current:
+            continue
+        chunks.append("Thread %s (%d):\n%s" % (
+            names.get(ident, "<unknown>"), ident,
+            "".join(traceback.format_stack(frame))))
+    return "\n".join(chunks)
+
+class IndexedAutoTracer:
+    """ Autotracer that traces only the functions found in an index of code
+    objects built ahead of time, instead of checking the path of every called
+    function. On Python 3.12+ it can use sys.monitoring, in which case only
+    the indexed functions generate events at all. Otherwise sys.settrace is
+    used, with a local trace function for the indexed functions only.
+
+    Keywords are written through the given start_keyword(name, kwtype),
+    end_keyword(keyword, result, error_msg) and log_message(msg, level)
+    callbacks. """
+
+    TOOL_ID = 2     # sys.monitoring.PROFILER_ID
+
+    # Functions that suspend and resume don't map to a single keyword
+    SKIPPED_CODE_FLAGS = (inspect.CO_GENERATOR | inspect.CO_COROUTINE |
+                          inspect.CO_ASYNC_GENERATOR)
+
+    # A frame returning by other instructions is unwound by an exception
+    RETURN_OPCODES = frozenset(dis.opmap[name]
+        for name in ("RETURN_VALUE", "RETURN_CONST") if name in dis.opmap)
+
+    def __init__(self, start_keyword, end_keyword, log_message, capture_value,
+                 libpaths,
+                 privates=False, include=None, exclude=None,
+                 use_monitoring=True):
+        self._start_keyword = start_keyword
+        self._end_keyword = end_keyword
+        self._log_message = log_message
+        self._capture_value = capture_value
+        self._libpaths = [os.path.join(os.path.abspath(path), "")
+                          for path in libpaths]
+        self._privates = privates
+        self._include = include or []
+        self._exclude = exclude or []
+
+        self._index = {}        # code object -> keyword name
+        self._modules = set()
+        self._modules_seen = 0
+        self._open = []         # (code object, keyword) of running functions
+        self._raised = {}       # frame -> last exception raised through it
+        self._kwtype = None
+        self._thread = None
+
+        self._monitoring = use_monitoring and hasattr(sys, "monitoring")
+        if self._monitoring:
+            try:
+                sys.monitoring.use_tool_id(self.TOOL_ID, "tracerobot")
+            except ValueError:
+                # another profiler is using the tool id
+                self._monitoring = False
+
+    @property
+    def uses_monitoring(self):
+        return self._monitoring
+
+    def _is_traced_path(self, filename):
+        path = os.path.abspath(filename)
+        return any(path.startswith(libpath) for libpath in self._libpaths)
+
+    def _is_traced_module(self, name, module):
+        if name == __name__ or name.split(".")[0] == "tracerobot":
+            return False
+        filename = getattr(module, "__file__", None)
+        return bool(filename) and self._is_traced_path(filename)
+
+    def _is_traced_name(self, qualname):
+        if self._include and not any(
+                fnmatch.fnmatchcase(qualname, pattern)
+                for pattern in self._include):
+            return False
+        return not any(
+            fnmatch.fnmatchcase(qualname, pattern) for pattern in self._exclude)
+
+    def _index_function(self, obj, module, filename):
+        if isinstance(obj, (staticmethod, classmethod)):
+            obj = obj.__func__
+        # fixture setups are traced as keywords by the plugin itself
+        if not inspect.isfunction(obj) or \
+                hasattr(obj, "_pytestfixturefunction"):
+            return
+
+        code = obj.__code__
+        # skips imported functions and wrappers made by decorators
+        if os.path.abspath(code.co_filename) != filename:
+            return
+        if code.co_flags & self.SKIPPED_CODE_FLAGS:
+            return
+        if obj.__name__.startswith("_") and not self._privates:
+            return
+        if not self._is_traced_name(module.__name__ + "." + obj.__qualname__):
+            return
+
+        self._index[code] = obj.__qualname__
+        if self._monitoring:
+            events = sys.monitoring.events
+            sys.monitoring.set_local_events(
+                self.TOOL_ID, code, events.PY_START | events.PY_RETURN)
+
+    def _index_module(self, module):
+        filename = os.path.abspath(module.__file__)
+        for obj in list(vars(module).values()):
+            if inspect.isclass(obj):
+                if obj.__module__ == module.__name__:
+                    for attr in list(vars(obj).values()):
+                        self._index_function(attr, module, filename)
+            else:
+                self._index_function(obj, module, filename)
+
+    def refresh(self):
+        """ Index the functions of modules imported since last refresh. """
+        if len(sys.modules) == self._modules_seen:
+            return
+        self._modules_seen = len(sys.modules)
+
+        for name, module in list(sys.modules.items()):
+            if name in self._modules:
+                continue
+            self._modules.add(name)
+            if self._is_traced_module(name, module):
+                self._index_module(module)
+
+    def set_kwtype(self, kwtype):
+        """ Applies to the next traced function only. """
+        self._kwtype = kwtype
+
+    def _enter(self, code, frame):
+        kwtype = self._kwtype or "kw"
+        self._kwtype = None
+        keyword = self._start_keyword(self._index[code], kwtype)
+        self._open.append((code, keyword))
+
+        argnames = code.co_varnames[:code.co_argcount + code.co_kwonlyargcount]
+        args = []
+        for argname in argnames:
+            if argname in ("self", "cls"):
+                continue
+            value = self._capture_value(frame.f_locals.get(argname))
+            if value is not None:
+                args.append("%s=%s" % (argname, value))
+        if args:
+            self._log_message("Arguments: " + ", ".join(args), level="DEBUG")
+
+    def _leave(self, result=None, error_msg=None):
+        _, keyword = self._open.pop(-1)
+        self._end_keyword(keyword, result, error_msg)
+
+    def _format_exception(self, exception):
+        return "%s: %s" % (type(exception).__name__, exception)
+
+    def _trace(self, frame, event, arg):
+        if event == "call" and frame.f_code in self._index:
+            # Python 3.6 frames have no per-frame switch for line events
+            if hasattr(frame, "f_trace_lines"):
+                frame.f_trace_lines = False
+            self._enter(frame.f_code, frame)
+            return self._trace_indexed
+        return None
+
+    def _trace_indexed(self, frame, event, arg):
+        if event == "exception":
+            self._raised[frame] = arg[1]
+        elif event == "return":
+            exception = self._raised.pop(frame, None)
+            if self._open and self._open[-1][0] is frame.f_code:
+                code = frame.f_code.co_code
+                if code[frame.f_lasti] in self.RETURN_OPCODES:
+                    self._leave(arg)
+                else:
+                    self._leave(error_msg=self._format_exception(exception))
+        return self._trace_indexed
+
+    def _on_py_start(self, code, offset):
+        if threading.get_ident() == self._thread:
+            self._enter(code, sys._getframe(1))
+
+    def _on_py_return(self, code, offset, retval):
+        if threading.get_ident() == self._thread and \
+                self._open and self._open[-1][0] is code:
+            self._leave(retval)
+
+    def _on_py_unwind(self, code, offset, exception):
+        if threading.get_ident() == self._thread and \
+                self._open and self._open[-1][0] is code:
+            self._leave(error_msg=self._format_exception(exception))
+
+    def start(self):
+        self.refresh()
+        self._thread = threading.get_ident()
+
+        if self._monitoring:
+            monitoring = sys.monitoring
+            events = monitoring.events
+            monitoring.register_callback(
+                self.TOOL_ID, events.PY_START, self._on_py_start)
+            monitoring.register_callback(
+                self.TOOL_ID, events.PY_RETURN, self._on_py_return)
+            monitoring.register_callback(
+                self.TOOL_ID, events.PY_UNWIND, self._on_py_unwind)
+            monitoring.set_events(self.TOOL_ID, events.PY_UNWIND)
+        else:
+            sys.settrace(self._trace)
+
+    def stop(self):
+        if self._monitoring:
+            monitoring = sys.monitoring
+            events = monitoring.events
+            monitoring.set_events(self.TOOL_ID, 0)
+            for event in (events.PY_START, events.PY_RETURN, events.PY_UNWIND):
+                monitoring.register_callback(self.TOOL_ID, event, None)
+        else:
+            sys.settrace(None)
+
+        while self._open:
+            self._leave()
+        self._raised.clear()
+        self._kwtype = None
+
+    def close(self):
+        if self._monitoring:
+            sys.monitoring.free_tool_id(self.TOOL_ID)
+            self._monitoring = False
 
 class TraceRobotPlugin:
     def __init__(self, config):
 
         self.config = config
         self._stack = []
-        self._logger = TraceRobotPythonLogger()
+        self._keywords = []
+        self._fixtures = []
+        self._fixture_graphs = {}
+        self._test_nodeids = []
+        self._param_groups = set()
+        self._test_outcomes = {}
+        self._finished_tests = {}
+        self._watchdog = None
+        # Serializes trace writes with the watchdog thread
+        self._trace_lock = threading.RLock()
+        self._logger = TraceRobotPythonLogger(self._trace_lock)
+        self._events = None
+        self._autotracer = None
+        self.results = TraceRobotResults(config.getoption("robot_slowest"))
+        self._values = ValueCapturePolicy(
+            maxlength=config.getoption("robot_value_maxlen"),
+            maxitems=config.getoption("robot_value_maxitems"),
+            enabled=not config.getoption("robot_no_values"))
 
     @property
     def current_path(self):
         return [path for path, _ in self._stack]
 
+    def _emit(self, event, **fields):
+        if self._events:
+            self._events.emit(event, **fields)
+
+    def _start_auto_trace(self):
+        if self._autotracer:
+            self._autotracer.start()
+        else:
+            tracerobot.start_auto_trace()
+
+    def _stop_auto_trace(self):
+        if self._autotracer:
+            self._autotracer.stop()
+        else:
+            tracerobot.stop_auto_trace()
+
+    def _set_auto_trace_kwtype(self, kwtype):
+        if self._autotracer:
+            self._autotracer.set_kwtype(kwtype)
+        else:
+            tracerobot.set_auto_trace_kwtype(kwtype)
+
+    def _clear_auto_trace_kwtype(self):
+        """ Drop a setup kwtype not used by the fixture it was meant for, so
+        that it cannot apply to the test body. """
+        if self._autotracer:
+            self._autotracer.set_kwtype(None)
+
     def _start_suite(self, name):
         # TODO: How to get meaningful suite docstring/metadata/source?
-        suite = tracerobot.start_suite(name)
-        self._stack.append((name, suite))
+        with self._trace_lock:
+            suite = tracerobot.start_suite(name)
+            self._stack.append((name, suite))
+        self._emit("start_suite", name=name, path=self.current_path)
 
     def _end_suite(self):
-        _, suite = self._stack.pop(-1)
-        tracerobot.end_suite(suite)
+        path = self.current_path
+        with self._trace_lock:
+            name, suite = self._stack.pop(-1)
+            tracerobot.end_suite(suite)
+        self._emit("end_suite", name=name, path=path)
+
+    def _start_keyword(self, name, kwtype="kw"):
+        with self._trace_lock:
+            keyword = tracerobot.start_keyword(name, kwtype)
+            self._keywords.append((name, kwtype))
+        self._emit("start_keyword", name=name, type=kwtype)
+        return keyword
+
+    def _end_keyword(self, keyword, result=None, error_msg=None):
+        result = self._values.capture(result)
+        with self._trace_lock:
+            tracerobot.end_keyword(keyword, result, error_msg=error_msg)
+            name, kwtype = self._keywords.pop(-1)
+        self._emit("end_keyword", name=name, type=kwtype,
+            status="FAIL" if error_msg else "PASS")
+
+    def _log_message(self, msg, level="INFO"):
+        with self._trace_lock:
+            tracerobot.log_message(msg, level=level)
 
     def _get_error_msg(self, call):
         if call and call.excinfo:
@@ -126,13 +728,25 @@ class TraceRobotPlugin:
 
         markers = [marker.name for marker in item.iter_markers()]
 
-        item.rt_test_info = tracerobot.start_test(
-            name=item.name,
-            doc=item.function.__doc__,
-            tags=markers)
+        with self._trace_lock:
+            item.rt_test_info = tracerobot.start_test(
+                name=item.name,
+                doc=item.function.__doc__,
+                tags=markers)
         item.rt_test_with_setup_and_teardown = with_setup_and_teardown
+        item.rt_test_tags = markers
+        item.rt_test_start_time = time.time()
+        self._emit("start_test", name=item.name, nodeid=item.nodeid)
 
-        tracerobot.start_auto_trace()
+        if self._fixture_mode == "compact" and \
+                not self._is_compact_fixture_test(item):
+            self._log_fixture_graph(item)
+        if self._fixture_mode != "flat":
+            self._log_cached_fixtures(item)
+
+        self._start_watchdog(item)
+
+        self._start_auto_trace()
 
     def _start_test_setup(self, item, fixturedef):
         assert self._is_test_with_setup_and_teardown
@@ -140,12 +754,18 @@ class TraceRobotPlugin:
         if self._has_test_setup(item):
             self._finish_test_setup(item)
 
+        if self._is_compact_fixture_test(item):
+            item.rt_fixture_timings = []
+            item.rt_test_setup_info = self._start_keyword("fixture(s)", "setup")
+
         # Applies to next keyword function called, returns automatically to "kw"
-        tracerobot.set_auto_trace_kwtype('setup')
+        self._set_auto_trace_kwtype('setup')
 
     def _finish_test_setup(self, item, call=None):
         if self._has_test_setup(item):
             error_msg = self._get_error_msg(call)
+            self._log_fixture_timings(item)
+            self._end_keyword(item.rt_test_setup_info, error_msg=error_msg)
             item.rt_test_error_msg = error_msg
             item.rt_test_setup_info = None
 
@@ -159,19 +779,175 @@ class TraceRobotPlugin:
 
     def _start_test_teardown(self, item):
         assert self._is_test_with_setup_and_teardown
-        tracerobot.set_auto_trace_kwtype('teardown')
-        item.rt_test_teardown_info = tracerobot.start_keyword(
+        self._set_auto_trace_kwtype('teardown')
+        item.rt_test_teardown_info = self._start_keyword(
             "fixture(s)", "teardown")
 
     def _finish_test_teardown(self, item, call=None):
         if self._has_test_teardown(item):
             error_msg = self._get_error_msg(call)
-            tracerobot.end_keyword(item.rt_test_teardown_info, error_msg=error_msg)
+            self._end_keyword(item.rt_test_teardown_info, error_msg=error_msg)
             item.rt_test_teardown_error_msg = error_msg
             item.rt_test_teardown_info = None
 
+    @property
+    def _fixture_mode(self):
+        return self.config.getoption("robot_fixtures")
+
+    def _is_compact_fixture_test(self, item):
+        """ In compact mode, the fixture graph and fixture keywords are written
+        only for tests using fixtures not yet seen in the same module. The
+        other tests just record fixture setup timings. """
+        try:
+            return item.rt_compact_fixtures
+        except AttributeError:
+            pass
+
+        compact = False
+        item.rt_new_fixtures = set()
+        if self._fixture_mode == "compact":
+            module = item.nodeid.split("::")[0]
+            known = self._fixture_graphs.setdefault(module, set())
+            names = set(name for name, _ in self._get_fixturedefs(item))
+            compact = names <= known
+            item.rt_new_fixtures = names - known
+            known.update(names)
+
+        item.rt_compact_fixtures = compact
+        return compact
+
+    def _get_fixturedefs(self, item):
+        """ Yield (name, fixturedef) of the fixtures used by a test. """
+        name2fixturedefs = item._fixtureinfo.name2fixturedefs
+        for name in item.fixturenames:
+            fixturedefs = name2fixturedefs.get(name)
+            if fixturedefs:
+                yield name, fixturedefs[-1]
+
+    def _log_fixture_graph(self, item):
+        """ Log the fixtures of the test not yet logged in its module. """
+        lines = []
+        for name, fixturedef in self._get_fixturedefs(item):
+            if name not in item.rt_new_fixtures:
+                continue
+            deps = [arg for arg in fixturedef.argnames if arg != "request"]
+            line = "%s (%s)" % (name, fixturedef.scope)
+            if deps:
+                line += ": " + ", ".join(deps)
+            lines.append(line)
+
+        if lines:
+            self._log_message("Fixture graph:\n" + "\n".join(lines))
+
+    def _log_cached_fixtures(self, item):
+        """ Log the higher-scope fixtures reused from earlier tests. """
+        set_up = getattr(item, "rt_fixture_setups", ())
+        cached = ["%s (%s)" % (name, fixturedef.scope)
+            for name, fixturedef in self._get_fixturedefs(item)
+            if fixturedef.scope != "function" and name not in set_up
+            and fixturedef.cached_result is not None]
+
+        if cached:
+            self._log_message("Cached fixtures: " + ", ".join(cached),
+                              level="DEBUG")
+
+    def _log_fixture_timings(self, item):
+        timings = getattr(item, "rt_fixture_timings", None)
+        if timings:
+            self._log_message("Fixture setup times:\n" + "\n".join(
+                "%s (%s): %.3f s" % timing for timing in timings))
+
+    def _get_fixture_chain(self, request):
+        """ Return the requests of the fixtures that (transitively) depend
+        on the fixture being set up, outermost first. """
+        chain = []
+        parent = getattr(request, "_parent_request", None)
+        # only fixture requests have a parent, the test's own request doesn't
+        while hasattr(parent, "_parent_request"):
+            chain.append(parent)
+            parent = parent._parent_request
+        chain.reverse()
+        return chain
+
+    def _start_fixtures(self, fixturedef, chain):
+        """ Open a keyword for the fixture, nested in the keywords of the
+        fixtures depending on it. pytest sets up the dependencies of a
+        fixture before the fixture itself, so the keywords of the dependent
+        fixtures are opened here, on the setup of their first dependency. """
+        if self._fixture_mode == "flat":
+            keyword = self._start_keyword(fixturedef.argname, "setup")
+            self._fixtures.append((fixturedef, keyword))
+            return
+
+        target = [request._fixturedef for request in chain] + [fixturedef]
+        opened = common_items([fd for fd, _ in self._fixtures], target)
+        self._end_fixtures(len(opened))
+
+        for fd in target[len(opened):]:
+            keyword = self._start_keyword(fd.argname, "setup")
+            if fd.scope != "function":
+                self._log_message("Scope: " + fd.scope, level="DEBUG")
+            self._fixtures.append((fd, keyword))
+
+    def _pop_fixture(self, fixturedef):
+        """ Return the keyword of the fixture, or None if it was already
+        ended. """
+        for index in range(len(self._fixtures) - 1, -1, -1):
+            if self._fixtures[index][0] is fixturedef:
+                _, keyword = self._fixtures.pop(index)
+                return keyword
+        return None
+
+    def _end_fixtures(self, count=0, error_msg=None):
+        while len(self._fixtures) > count:
+            _, keyword = self._fixtures.pop(-1)
+            self._end_keyword(keyword, error_msg=error_msg)
+
+    def _report_hang(self, item, timeout):
+        """ Called from the watchdog thread when a test is still running
+        after timeout seconds.
+
+        The report is written into the trace only with --autotrace-index:
+        the tracerobot autotracer writes keywords without taking the trace
+        lock, so the report could land in the middle of its output, and its
+        keywords are not known to the plugin. Otherwise the report goes to
+        stderr instead. """
+        in_trace = self._autotracer is not None
+        with self._trace_lock:
+            keywords = [name for name, _ in self._keywords]
+            msg = "Test %s still running after %.1f seconds\n" % (
+                item.nodeid, timeout)
+            msg += "Open keywords: %s\n\n" % (" > ".join(keywords) or "(none)")
+            msg += format_thread_stacks()
+
+            if in_trace:
+                tracerobot.log_message(msg, level="WARN")
+
+        self._emit("test_timeout", name=item.name, nodeid=item.nodeid,
+            keywords=keywords)
+
+        if not in_trace or self.config.getoption("robot_timeout_stderr"):
+            sys.__stderr__.write("\n" + msg + "\n")
+            sys.__stderr__.flush()
+
+    def _start_watchdog(self, item):
+        # a test that never finished its envelope must not be reported later
+        self._stop_watchdog()
+
+        timeout = self.config.getoption("robot_test_timeout")
+        if timeout:
+            self._watchdog = TraceRobotWatchdog(
+                timeout, lambda: self._report_hang(item, timeout))
+            self._watchdog.start()
+
+    def _stop_watchdog(self):
+        if self._watchdog:
+            self._watchdog.stop()
+            self._watchdog = None
+
     def _finish_test_envelope(self, item, call=None):
-        tracerobot.stop_auto_trace()
+        self._stop_watchdog()
+        self._stop_auto_trace()
 
         if self._is_test_started(item):
             if call.excinfo:
@@ -179,9 +955,60 @@ class TraceRobotPlugin:
             else:
                 error_msg = self._get_test_error_msg(item)
 
-            tracerobot.end_test(item.rt_test_info, error_msg)
+            with self._trace_lock:
+                tracerobot.end_test(item.rt_test_info, error_msg)
             item.rt_test_info = None
+            self._test_nodeids.append(item.nodeid)
+
+            elapsed = time.time() - item.rt_test_start_time
+            # added to the results once all phases have been reported
+            self._finished_tests[item.nodeid] = (item.rt_test_tags, elapsed)
+            self._emit("end_test", name=item.name, nodeid=item.nodeid,
+                status="FAIL" if error_msg else "PASS", elapsed=elapsed)
+
+
+    def _warn(self, msg):
+        reporter = self.config.pluginmanager.get_plugin("terminalreporter")
+        if reporter:
+            reporter.write_line("tracerobot: " + msg, yellow=True)
+
+    def _index_output(self):
+        """ Map the test elements of the XML output to test nodeids.
+        Tests cannot be nested, so their elements are written to the output
+        in the order the tests end. """
+        output = self.config.getoption("robot_output")
+        offsets = scan_test_elements(output)
+        if len(offsets) != len(self._test_nodeids):
+            self._warn("cannot index %s: found %d test elements for %d tests" %
+                (output, len(offsets), len(self._test_nodeids)))
+            return None
+
+        return [(nodeid, start, end)
+            for nodeid, (start, end) in zip(self._test_nodeids, offsets)]
+
+    def _splice_output(self, tests):
+        """ Splice the tests of this run into an earlier, indexed output. """
+        output = self.config.getoption("robot_output")
+        target = self.config.getoption("robot_splice_into")
+        target_index_path = sidecar_path(target, ".index.json")
+
+        try:
+            target_index = read_test_index(target_index_path)
+        except (OSError, ValueError) as e:
+            self._warn("cannot splice into %s: %s" % (target, e))
+            return
+
+        if target_index["size"] != os.path.getsize(target):
+            self._warn("cannot splice into %s: %s is out of date" %
+                (target, target_index_path))
+            return
+
+        spliced, missing = splice_test_elements(
+            target, target_index["tests"], output, tests)
+        write_test_index(target_index_path, target, spliced)
 
+        for nodeid in missing:
+            self._warn("%s not found in %s, not spliced" % (nodeid, target))
 
     # Initialization hooks
 
@@ -192,27 +1019,113 @@ class TraceRobotPlugin:
             tracerobot_config[var] = self.config.getoption(var)
         tracerobot.tracerobot_init(tracerobot_config)
 
+        if self.config.getoption("autotrace_index"):
+            libpaths = [os.getcwd()]
+            libpaths += self.config.getoption("autotrace_libpaths") or []
+            self._autotracer = IndexedAutoTracer(
+                self._start_keyword, self._end_keyword, self._log_message,
+                self._values.capture,
+                libpaths,
+                privates=self.config.getoption("autotrace_privates"),
+                include=self.config.getoption("autotrace_include"),
+                exclude=self.config.getoption("autotrace_exclude"),
+                use_monitoring=self.config.getoption(
+                    "autotrace_backend") != "settrace")
+            self._autotracer.refresh()
+
+        events_path = self.config.getoption("robot_events")
+        if events_path:
+            self._events = TraceRobotEventStream(events_path)
+            self._emit("start_session")
+
         logging.getLogger().setLevel(logging.DEBUG)
         logging.getLogger().addHandler(self._logger)
 
 
+    def pytest_collection_finish(self, session):
+        # test modules have been imported now
+        if self._autotracer:
+            self._autotracer.refresh()
+
+        if self.config.getoption("robot_group_params"):
+            self._find_param_groups(item.nodeid for item in session.items)
+
     def pytest_sessionfinish(self, session, exitstatus):
         while self._stack:
             self._end_suite()
 
         tracerobot.close()
 
+        if self._autotracer:
+            self._autotracer.close()
+
+        if self.config.getoption("robot_summary"):
+            output = self.config.getoption("robot_output")
+            with open(sidecar_path(output, ".summary.json"), "w",
+                      encoding="utf-8") as f:
+                json.dump(self.results.as_dict(), f, indent=2)
+
+        self.config.hook.pytest_tracerobot_results(
+            config=self.config, results=self.results)
+
+        write_index = self.config.getoption("robot_index")
+        splice_into = self.config.getoption("robot_splice_into")
+        if write_index or splice_into:
+            tests = self._index_output()
+            if tests is not None:
+                if write_index:
+                    output = self.config.getoption("robot_output")
+                    write_test_index(
+                        sidecar_path(output, ".index.json"), output, tests)
+                if splice_into:
+                    self._splice_output(tests)
+
+        if self._events:
+            self._emit("end_session", exitstatus=int(exitstatus))
+            self._events.close()
+            self._events = None
+
     # Test running hooks
 
+    def _find_param_groups(self, nodeids):
+        """ Find the parametrized tests whose variants all run one after
+        another. pytest reorders tests around higher-scope parametrized
+        fixtures, and grouping interleaved variants would split them into
+        many suites of the same name. """
+        runs = {}
+        previous = None
+        for nodeid in nodeids:
+            # split off parametrization ids first, they may contain anything
+            base, bracket, _ = nodeid.partition("[")
+            if bracket and base != previous:
+                runs[base] = runs.get(base, 0) + 1
+            previous = base if bracket else None
+
+        self._param_groups = set(
+            base for base, count in runs.items() if count == 1)
+
+    def _get_suite_path(self, nodeid):
+        """ Suite path of a test: directories, test file, test classes and,
+        if parametrized variants are grouped, the test function. """
+        # split off parametrization ids first, they may contain anything
+        base, bracket, _ = nodeid.partition("[")
+        parts = base.split("::")
+
+        path = parts[0].split("/")
+        # "()" is the instance node of older pytest versions
+        path.extend(part for part in parts[1:-1] if part != "()")
+
+        if bracket and base in self._param_groups:
+            path.append(parts[-1])
+
+        return path
+
     def pytest_runtest_logstart(self, nodeid, location):
-        """Each directory and test file maps to a Robot Framework suite.
-        Because pytest doesn't seem to provide hook for entering/leaving
+        """Each directory, test file and test class maps to a Robot Framework
+        suite. Because pytest doesn't seem to provide hook for entering/leaving
         suites as such, the current suite must be determined before each test.
         """
-        #filename, linenum, testname = location
-        filename, _, _ = location
-
-        target = filename.split(os.sep)
+        target = self._get_suite_path(nodeid)
         common = common_items(self.current_path, target)
 
         while len(self.current_path) > len(common):
@@ -237,24 +1150,55 @@ class TraceRobotPlugin:
             # Note: run pytest with -s to see these
             print("\npytest_fixture_setup", fixturedef, request, request.node)
 
-        if scope == 'function':
-            # Function-scope fixtures can be starting a new test case
-            item = request.node
+        item = request._pyfuncitem
+        if not hasattr(item, "rt_fixture_setups"):
+            item.rt_fixture_setups = set()
+        item.rt_fixture_setups.add(fixturedef.argname)
 
+        # fixtures requested later, e.g. by request.getfixturevalue() in the
+        # test body, are traced as keywords
+        setup_done = getattr(item, "rt_setup_done", False)
+        if self._is_compact_fixture_test(item) and not setup_done:
+            # All setup is attributed to the test, only timings are recorded
             if not self._is_test_started(item):
                 self._start_test_envelope(
                     item, with_setup_and_teardown=True)
                 self._start_test_setup(item, fixturedef)
 
-        fixture = tracerobot.start_keyword(
-            name=fixturedef.argname,
-            type="setup"
-        )
+            start_time = time.time()
+            yield
+            self._clear_auto_trace_kwtype()
+            item.rt_fixture_timings.append(
+                (fixturedef.argname, scope, time.time() - start_time))
+            return
 
-        outcome = yield
+        chain = []
+        if self._fixture_mode != "flat":
+            chain = self._get_fixture_chain(request)
+
+        if scope == 'function' or any(
+                r._fixturedef.scope == 'function' for r in chain):
+            # Function-scope fixtures can be starting a new test case
+            if not self._is_test_started(item):
+                self._start_test_envelope(
+                    item, with_setup_and_teardown=True)
+                self._start_test_setup(item, fixturedef)
+
+        self._start_fixtures(fixturedef, chain)
 
-        result = outcome.get_result()
-        tracerobot.end_keyword(fixture, result)
+        outcome = yield
+        self._clear_auto_trace_kwtype()
+
+        fixture = self._pop_fixture(fixturedef)
+        if fixture is None:
+            pass
+        elif outcome.excinfo:
+            exc_type, exc_value, _ = outcome.excinfo
+            error_msg = "".join(
+                traceback.format_exception_only(exc_type, exc_value)).strip()
+            self._end_keyword(fixture, error_msg=error_msg)
+        else:
+            self._end_keyword(fixture, outcome.get_result())
 
 
     #def pytest_fixture_setup(self, fixturedef, request):
@@ -290,6 +1234,10 @@ class TraceRobotPlugin:
 
         if call.when == "setup":
             #  finish setup phase (if any), start test body
+            item.rt_setup_done = True
+
+            # fixtures whose dependency failed were never set up
+            self._end_fixtures(error_msg=self._get_error_msg(call))
 
             if self._is_test_with_setup_and_teardown(item):
                 self._finish_test_setup(item, call)
@@ -299,6 +1247,9 @@ class TraceRobotPlugin:
                     self._finish_test_envelope(item, call)
             else:
                 self._start_test_envelope(item)
+                if call.excinfo:
+                    # e.g. skipped or failed in a setup hook before fixtures
+                    self._finish_test_envelope(item, call)
 
         # pytest_runtest_call(item) gets called between "setup" and "call"
 
@@ -317,16 +1268,42 @@ class TraceRobotPlugin:
                 self._finish_test_envelope(item, call)
 
 
-    def pytest_assertion_pass(item, lineno, orig, expl):
+    def pytest_runtest_logreport(self, report):
+        if report.failed:
+            outcome = "failed"
+        elif report.skipped:
+            outcome = "skipped"     # also xfail
+        else:
+            outcome = "passed"
+
+        # a failure in any phase fails the test, a skip in any phase skips it
+        previous = self._test_outcomes.get(report.nodeid, "passed")
+        if previous == "failed" or (previous == "skipped" and outcome == "passed"):
+            outcome = previous
+        self._test_outcomes[report.nodeid] = outcome
+
+    def pytest_runtest_logfinish(self, nodeid, location):
+        self._stop_watchdog()
+
+        outcome = self._test_outcomes.pop(nodeid, "passed")
+        finished = self._finished_tests.pop(nodeid, None)
+        if finished:
+            tags, elapsed = finished
+            self.results.add_test(nodeid, tags, outcome, elapsed)
+
+    def pytest_assertion_pass(self, item, lineno, orig, expl):
 
         if HOOK_DEBUG:
             print("\n pytest_assertion_pass", lineno, orig, expl)
 
-        assert_kw = tracerobot.start_keyword("assert")
-        tracerobot.log_message(orig)
-        tracerobot.end_keyword(assert_kw)
+        assert_kw = self._start_keyword("assert")
+        self._log_message(orig)
+        self._end_keyword(assert_kw)
 
 
+def pytest_addhooks(pluginmanager):
+    pluginmanager.add_hookspecs(TraceRobotHookSpecs)
+
 def pytest_addoption(parser):
     group = parser.getgroup('tracerobot')
     group.addoption(
@@ -346,9 +1323,133 @@ def pytest_addoption(parser):
         nargs="*",
         help='List of paths for which the autotracer is enabled.'
     )
+    group.addoption(
+        '--autotrace-index',
+        default=False,
+        action='store_true',
+        help='If set, index the traceable functions ahead of time and trace '
+             'only those, instead of checking each call by its path.'
+    )
+    group.addoption(
+        '--autotrace-include',
+        nargs="*",
+        metavar='PATTERN',
+        help='With --autotrace-index, trace only functions whose qualified '
+             'name (module.Class.function) matches one of the patterns.'
+    )
+    group.addoption(
+        '--autotrace-exclude',
+        nargs="*",
+        metavar='PATTERN',
+        help='With --autotrace-index, do not trace functions whose qualified '
+             'name matches one of the patterns.'
+    )
+    group.addoption(
+        '--autotrace-backend',
+        default='auto',
+        choices=['auto', 'settrace', 'monitoring'],
+        help='Tracing mechanism of --autotrace-index: sys.settrace, or '
+             'sys.monitoring (Python 3.12+). Default: auto.'
+    )
+    group.addoption(
+        '--robot-events',
+        metavar='SOCKET',
+        help='Path to a Unix domain socket where trace events are streamed '
+             'as newline-delimited JSON (see tracerobot_listen.py).'
+    )
+    group.addoption(
+        '--robot-test-timeout',
+        type=float,
+        metavar='SECONDS',
+        help='Report open keywords and thread stacks of a test that is '
+             'still running after this many seconds. The report is written '
+             'into the trace with --autotrace-index, otherwise to stderr.'
+    )
+    group.addoption(
+        '--robot-timeout-stderr',
+        default=False,
+        action='store_true',
+        help='On test timeout, also write the diagnostics to stderr.'
+    )
+    group.addoption(
+        '--robot-group-params',
+        default=False,
+        action='store_true',
+        help='If set, variants of a parametrized test are grouped into a '
+             'suite named after the test function, if they run one after '
+             'another.'
+    )
+    group.addoption(
+        '--robot-fixtures',
+        default='flat',
+        choices=['flat', 'tree', 'compact'],
+        help='How fixture setups are traced: flat (default), nested by '
+             'dependencies (tree), or as a tree for the first test of each '
+             'module and as setup timings for the rest (compact).'
+    )
+    group.addoption(
+        '--robot-index',
+        default=False,
+        action='store_true',
+        help='Write an index of test element offsets next to the XML '
+             'output, so that re-runs can be spliced into it.'
+    )
+    group.addoption(
+        '--robot-splice-into',
+        metavar='PATH',
+        help='Replace the tests of an earlier indexed XML output with the '
+             'tests of this run (e.g. with --lf).'
+    )
+    group.addoption(
+        '--robot-summary',
+        default=False,
+        action='store_true',
+        help='Write a JSON summary of the results (counts, per-tag counts, '
+             'durations and slowest tests) next to the XML output.'
+    )
+    group.addoption(
+        '--robot-slowest',
+        type=int,
+        default=10,
+        metavar='N',
+        help='Number of slowest tests listed in the results summary.'
+    )
+    group.addoption(
+        '--robot-value-maxlen',
+        type=int,
+        default=1000,
+        help='Maximum length of a traced value representation.'
+    )
+    group.addoption(
+        '--robot-value-maxitems',
+        type=int,
+        default=20,
+        help='Maximum number of container items in a traced value.'
+    )
+    group.addoption(
+        '--robot-no-values',
+        default=False,
+        action='store_true',
+        help='If set, keyword return values are not traced at all.'
+    )
 
     # TODO: should auto-tracing be configurable on/off?
 
 def pytest_configure(config):
+    if config.getoption("robot_events") and not hasattr(socket, "AF_UNIX"):
+        raise pytest.UsageError(
+            "--robot-events requires Unix domain socket support")
+
+    if config.getoption("autotrace_backend") == "monitoring" and \
+            not hasattr(sys, "monitoring"):
+        raise pytest.UsageError(
+            "--autotrace-backend=monitoring requires Python 3.12 or newer")
+
+    splice_into = config.getoption("robot_splice_into")
+    if splice_into and os.path.abspath(splice_into) == \
+            os.path.abspath(config.getoption("robot_output")):
+        raise pytest.UsageError(
+            "--robot-splice-into must differ from --robot-output")
+
     plugin = TraceRobotPlugin(config)
-    config.pluginmanager.register(plugin)
+    config.pluginmanager.register(plugin, "tracerobot")
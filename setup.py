@@ -4,10 +4,11 @@ from setuptools import setup
 setup(
     name="pytest_tracerobot",
     version="0.3.0",
-    scripts=["pytest_tracerobot.py"],
+    scripts=["pytest_tracerobot.py", "tracerobot_listen.py"],
     # the following makes a plugin available to pytest
     entry_points={"pytest11": ["name_of_plugin=pytest_tracerobot"]},
     # custom PyPI classifier for pytest plugins
     classifiers=["Framework :: Pytest"],
+    python_requires=">=3.6",
     install_requires=["tracerobot >= 0.3.0", "pytest >= 4.3.0"]
 )
@@ -38,6 +38,20 @@ def moduleFixture():
     yield
     rlog("module teardown")
 
+@pytest.fixture
+def dependentFixture(moduleFixture, fixtureWithSetupAndTeardown1):
+    rlog("dependent setup")
+    yield
+    rlog("dependent teardown")
+
+@pytest.fixture
+def dynamicFixture(request):
+    return request.getfixturevalue("fixtureWithSetup")
+
+@pytest.fixture
+def fixtureWithFailingDependency(fixtureWithSetupError):
+    rlog("never reached")
+
 @pytest.fixture
 def fixtureWithSetupError():
     assert False
@@ -91,6 +105,21 @@ def test_module_and_test_fixtures(moduleFixture, fixtureWithSetupAndTeardown1):
     """ A test with one module-scoped and one function-scoped fixture """
     rlog("here")
 
+@pytest.mark.passing
+def test_fixture_dependencies(dependentFixture, fixtureWithSetupAndTeardown2):
+    """ A test with a fixture depending on other fixtures """
+    rlog("here")
+
+@pytest.mark.passing
+def test_dynamic_fixtures(request, dynamicFixture):
+    """ A test with fixtures requested with request.getfixturevalue() """
+    request.getfixturevalue("fixtureWithSetupAndTeardown2")
+
+@pytest.mark.failing
+def test_fixture_dependency_error(fixtureWithFailingDependency):
+    """ A test with a fixture whose dependency fails in setup """
+    rlog("here")
+
 @pytest.mark.failing
 def test_setup_assert(fixtureWithSetupError):
     """ A test that fails in fixture setup phase """
@@ -118,3 +147,22 @@ def test_assert_in_test_body_and_teardown(fixtureWithTeardownError):
     """ A test that fails in fixture setup and teardown phase """
     rlog("here")
     check_sum(1,2,4)
+
+@pytest.mark.passing
+@pytest.mark.parametrize("a,b,result", [(1, 2, 3), (2, 2, 4), (0, 0, 0)])
+def test_parametrized(a, b, result):
+    """ A parametrized test, variants can be grouped with --robot-group-params """
+    check_sum(a, b, result)
+
+class TestClassSuite:
+    """ Tests within a class are traced in a suite of their own """
+
+    @pytest.mark.passing
+    def test_method(self):
+        """ A passing test method """
+        check_sum(1, 2, 3)
+
+    @pytest.mark.passing
+    def test_method_with_fixture(self, fixtureWithSetupAndTeardown1):
+        """ A test method with a function-scoped fixture """
+        rlog("here")
@@ -0,0 +1,556 @@
+""" Unit tests for the helpers of pytest-tracerobot.
+
+Unlike test.py, these tests check the results themselves:
+    pytest test_unit.py
+"""
+import importlib.util
+import json
+import socket
+import sys
+import threading
+import time
+import pytest
+import pytest_tracerobot
+
+pytest_plugins = ["pytester"]
+
+class FakeConfig:
+    """ Stands in for pytest's config, with the plugin's default options """
+
+    DEFAULTS = {
+        "robot_slowest": 10,
+        "robot_value_maxlen": 1000,
+        "robot_value_maxitems": 20,
+        "robot_no_values": False,
+        "robot_group_params": False,
+        "robot_test_timeout": None,
+        "robot_timeout_stderr": False,
+    }
+
+    def __init__(self, **options):
+        self.options = dict(self.DEFAULTS, **options)
+
+    def getoption(self, name):
+        return self.options[name]
+
+OUTPUT = (b'<robot><suite name="a">'
+          b'<test id="s1-t1" name="x"><kw name="k">&lt;test </kw></test>'
+          b'<test id="s1-t2" name="y">old y</test>'
+          b'<test id="s1-t3" name="z">old z</test>'
+          b'</suite><statistics/></robot>')
+
+RERUN = (b'<robot><suite name="a">'
+         b'<test id="s1-t1" name="y">new y</test>'
+         b'<test id="s1-t2" name="w">new w</test>'
+         b'</suite></robot>')
+
+def write_output(tmp_path, name, data):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+def index_output(path, nodeids):
+    offsets = pytest_tracerobot.scan_test_elements(path)
+    return [(nodeid, start, end) for nodeid, (start, end) in zip(nodeids, offsets)]
+
+def test_scan_test_elements(tmp_path):
+    path = write_output(tmp_path, "output.xml", OUTPUT)
+    offsets = pytest_tracerobot.scan_test_elements(path)
+
+    assert [OUTPUT[start:end] for start, end in offsets] == [
+        b'<test id="s1-t1" name="x"><kw name="k">&lt;test </kw></test>',
+        b'<test id="s1-t2" name="y">old y</test>',
+        b'<test id="s1-t3" name="z">old z</test>']
+
+def test_scan_empty_output(tmp_path):
+    path = write_output(tmp_path, "output.xml", b"")
+    assert pytest_tracerobot.scan_test_elements(path) == []
+
+def test_test_index_round_trip(tmp_path):
+    path = write_output(tmp_path, "output.xml", OUTPUT)
+    tests = index_output(path, ["a::x", "a::y", "a::z"])
+    index_path = pytest_tracerobot.sidecar_path(path, ".index.json")
+
+    pytest_tracerobot.write_test_index(index_path, path, tests)
+    index = pytest_tracerobot.read_test_index(index_path)
+
+    assert index_path == str(tmp_path / "output.index.json")
+    assert index["output"] == "output.xml"
+    assert index["size"] == len(OUTPUT)
+    assert [tuple(test) for test in index["tests"]] == tests
+
+def test_splice_test_elements(tmp_path):
+    target = write_output(tmp_path, "output.xml", OUTPUT)
+    source = write_output(tmp_path, "rerun.xml", RERUN)
+    target_tests = index_output(target, ["a::x", "a::y", "a::z"])
+    source_tests = index_output(source, ["a::y", "a::w"])
+
+    spliced, missing = pytest_tracerobot.splice_test_elements(
+        target, target_tests, source, source_tests)
+
+    data = (tmp_path / "output.xml").read_bytes()
+    assert data == OUTPUT.replace(
+        b'<test id="s1-t2" name="y">old y</test>',
+        b'<test id="s1-t1" name="y">new y</test>')
+    assert missing == ["a::w"]
+    assert [nodeid for nodeid, _, _ in spliced] == ["a::x", "a::y", "a::z"]
+    assert [data[start:end] for _, start, end in spliced] == [
+        data[start:end] for start, end in
+        pytest_tracerobot.scan_test_elements(target)]
+    assert not (tmp_path / "output.xml.splice").exists()
+
+def test_suite_path_of_module_test():
+    plugin = pytest_tracerobot.TraceRobotPlugin(FakeConfig())
+    assert plugin._get_suite_path("tests/test.py::test_a") == ["tests", "test.py"]
+
+def test_suite_path_of_class_tests():
+    plugin = pytest_tracerobot.TraceRobotPlugin(FakeConfig())
+    assert plugin._get_suite_path("a/test_b.py::TestX::TestY::test_z") == \
+        ["a", "test_b.py", "TestX", "TestY"]
+    # instance node of older pytest versions
+    assert plugin._get_suite_path("test_b.py::TestX::()::test_z") == \
+        ["test_b.py", "TestX"]
+
+def test_suite_path_of_parametrized_tests():
+    nodeid = "test_b.py::TestX::test_z[1-a::b/c]"
+
+    plugin = pytest_tracerobot.TraceRobotPlugin(FakeConfig())
+    assert plugin._get_suite_path(nodeid) == ["test_b.py", "TestX"]
+
+    plugin = pytest_tracerobot.TraceRobotPlugin(
+        FakeConfig(robot_group_params=True))
+    plugin._find_param_groups([nodeid, "test_b.py::TestX::test_z[2]",
+                               "test_b.py::test_q"])
+    assert plugin._get_suite_path(nodeid) == ["test_b.py", "TestX", "test_z"]
+    assert plugin._get_suite_path("test_b.py::test_q") == ["test_b.py"]
+
+def test_suite_path_of_interleaved_parametrized_tests():
+    # as ordered by a module-scoped parametrized fixture
+    nodeids = ["m.py::test_a[1]", "m.py::test_b[1]", "m.py::test_c[x]",
+               "m.py::test_c[y]", "m.py::test_a[2]", "m.py::test_b[2]"]
+    plugin = pytest_tracerobot.TraceRobotPlugin(
+        FakeConfig(robot_group_params=True))
+    plugin._find_param_groups(nodeids)
+
+    assert [plugin._get_suite_path(nodeid) for nodeid in nodeids] == [
+        ["m.py"], ["m.py"], ["m.py", "test_c"], ["m.py", "test_c"],
+        ["m.py"], ["m.py"]]
+
+needs_unix_sockets = pytest.mark.skipif(
+    not hasattr(socket, "AF_UNIX"), reason="requires Unix domain sockets")
+
+@needs_unix_sockets
+def test_event_stream_emit(tmp_path):
+    path = str(tmp_path / "events.sock")
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    listener.bind(path)
+    stream = pytest_tracerobot.TraceRobotEventStream(path)
+    try:
+        stream.emit("start_test", name="x", nodeid="a::x")
+        data = listener.recv(65536).decode("utf-8")
+    finally:
+        stream.close()
+        listener.close()
+
+    assert data.endswith("\n") and data.count("\n") == 1
+    event = json.loads(data)
+    assert event["event"] == "start_test"
+    assert (event["name"], event["nodeid"]) == ("x", "a::x")
+    assert isinstance(event["time"], float)
+    assert stream.dropped == 0
+
+@needs_unix_sockets
+def test_event_stream_without_listener(tmp_path):
+    stream = pytest_tracerobot.TraceRobotEventStream(
+        str(tmp_path / "events.sock"))
+    try:
+        stream.emit("start_session")
+        stream.emit("end_session", exitstatus=0)
+    finally:
+        stream.close()
+    assert stream.dropped == 2
+
+class FakeItem:
+    def __init__(self, nodeid):
+        self.nodeid = nodeid
+        self.name = nodeid.split("::")[-1]
+
+def test_format_thread_stacks():
+    started = threading.Event()
+    finished = threading.Event()
+    def blocked_in_test():
+        started.set()
+        finished.wait()
+
+    thread = threading.Thread(target=blocked_in_test, name="blocked")
+    thread.start()
+    try:
+        started.wait()
+        stacks = pytest_tracerobot.format_thread_stacks()
+    finally:
+        finished.set()
+        thread.join()
+
+    assert "Thread blocked (%d):" % thread.ident in stacks
+    assert "in blocked_in_test" in stacks
+    # the calling thread is not included
+    assert "in test_format_thread_stacks" not in stacks
+
+def test_watchdog_reports_once():
+    reports = []
+    plugin = pytest_tracerobot.TraceRobotPlugin(
+        FakeConfig(robot_test_timeout=0.05))
+    plugin._report_hang = lambda item, timeout: reports.append(item.nodeid)
+
+    plugin._start_watchdog(FakeItem("t::slow"))
+    deadline = time.time() + 5
+    while not reports and time.time() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.1)
+    plugin._stop_watchdog()
+
+    assert reports == ["t::slow"]
+
+def test_watchdog_of_previous_test_is_stopped():
+    reports = []
+    plugin = pytest_tracerobot.TraceRobotPlugin(
+        FakeConfig(robot_test_timeout=0.2))
+    plugin._report_hang = lambda item, timeout: reports.append(item.nodeid)
+
+    # e.g. the envelope of a skipped test was never finished
+    plugin._start_watchdog(FakeItem("t::skipped"))
+    plugin._start_watchdog(FakeItem("t::next"))
+    plugin._stop_watchdog()
+    time.sleep(0.3)
+
+    assert reports == []
+
+def test_hang_report_without_indexed_autotracer(monkeypatch, capfd):
+    logged = []
+    monkeypatch.setattr(pytest_tracerobot.tracerobot, "log_message",
+        lambda msg, level: logged.append(msg))
+    plugin = pytest_tracerobot.TraceRobotPlugin(FakeConfig())
+    plugin._keywords = [("db", "setup")]
+
+    plugin._report_hang(FakeItem("t::slow"), 1.0)
+
+    assert logged == []
+    err = capfd.readouterr().err
+    assert "Test t::slow still running after 1.0 seconds" in err
+    assert "Open keywords: db" in err
+
+def test_hang_report_with_indexed_autotracer(monkeypatch, capfd):
+    logged = []
+    monkeypatch.setattr(pytest_tracerobot.tracerobot, "log_message",
+        lambda msg, level: logged.append((msg, level)))
+    plugin = pytest_tracerobot.TraceRobotPlugin(FakeConfig())
+    plugin._autotracer = object()
+    plugin._keywords = [("db", "setup"), ("query", "kw")]
+
+    plugin._report_hang(FakeItem("t::slow"), 1.0)
+
+    assert len(logged) == 1
+    msg, level = logged[0]
+    assert level == "WARN"
+    assert "Open keywords: db > query" in msg
+    assert capfd.readouterr().err == ""
+
+TRACED_MODULE = """
+def ok(a):
+    return a + 1
+
+def boom():
+    raise ValueError("boom")
+
+def caught():
+    try:
+        boom()
+    except ValueError:
+        pass
+    return ok(1)
+
+def reraised():
+    try:
+        boom()
+    finally:
+        ok(2)
+
+def _private():
+    return 0
+"""
+
+@pytest.fixture(params=["settrace", "monitoring"])
+def autotracer(request, tmp_path):
+    if request.param == "monitoring" and not hasattr(sys, "monitoring"):
+        pytest.skip("sys.monitoring requires Python 3.12+")
+
+    path = tmp_path / "traced_module.py"
+    path.write_text(TRACED_MODULE)
+    spec = importlib.util.spec_from_file_location("traced_module", str(path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    sys.modules["traced_module"] = module
+
+    trace = []
+    def start_keyword(name, kwtype):
+        trace.append(("start", name, kwtype))
+        return name
+    def end_keyword(keyword, result, error_msg):
+        trace.append(("end", keyword, result, error_msg))
+    def log_message(msg, level):
+        trace.append(("log", msg))
+
+    tracer = pytest_tracerobot.IndexedAutoTracer(
+        start_keyword, end_keyword, log_message, repr, [str(tmp_path)],
+        use_monitoring=request.param == "monitoring")
+    assert tracer.uses_monitoring == (request.param == "monitoring")
+
+    yield tracer, module, trace
+
+    tracer.close()
+    del sys.modules["traced_module"]
+
+def test_autotracer_returns(autotracer):
+    tracer, module, trace = autotracer
+    tracer.set_kwtype("setup")
+    tracer.start()
+    module.ok(1)
+    module.caught()
+    module._private()
+    tracer.stop()
+    module.ok(5)
+
+    assert trace == [
+        ("start", "ok", "setup"), ("log", "Arguments: a=1"), ("end", "ok", 2, None),
+        ("start", "caught", "kw"),
+        ("start", "boom", "kw"), ("end", "boom", None, "ValueError: boom"),
+        ("start", "ok", "kw"), ("log", "Arguments: a=1"), ("end", "ok", 2, None),
+        ("end", "caught", 2, None)]
+
+def test_autotracer_exceptions(autotracer):
+    tracer, module, trace = autotracer
+    tracer.start()
+    with pytest.raises(ValueError):
+        module.reraised()
+    tracer.stop()
+
+    assert trace == [
+        ("start", "reraised", "kw"),
+        ("start", "boom", "kw"), ("end", "boom", None, "ValueError: boom"),
+        ("start", "ok", "kw"), ("log", "Arguments: a=2"), ("end", "ok", 3, None),
+        ("end", "reraised", None, "ValueError: boom")]
+
+def test_results_counts():
+    results = pytest_tracerobot.TraceRobotResults()
+    results.add_test("t::a", ["smoke"], "passed", 0.005)
+    results.add_test("t::b", ["smoke", "slow"], "failed", 2.0)
+    results.add_test("t::c", ["slow"], "skipped", 0.0)
+
+    assert (results.total, results.passed, results.failed, results.skipped) == \
+        (3, 1, 1, 1)
+    assert results.tags == {
+        "smoke": {"passed": 1, "failed": 1, "skipped": 0},
+        "slow": {"passed": 0, "failed": 1, "skipped": 1}}
+
+def test_results_durations_and_slowest():
+    results = pytest_tracerobot.TraceRobotResults(slowest_count=2)
+    for nodeid, elapsed in [("a", 0.005), ("b", 2.0), ("c", 0.5), ("d", 100.0)]:
+        results.add_test(nodeid, [], "passed", elapsed)
+
+    assert results.slowest == [("d", 100.0), ("b", 2.0)]
+    summary = results.as_dict()
+    assert summary["elapsed"] == pytest.approx(102.505)
+    assert summary["durations"] == {
+        "0.01": 1, "0.1": 0, "1.0": 1, "10.0": 1, "60.0": 0, "inf": 1}
+    assert summary["slowest"] == [
+        {"nodeid": "d", "elapsed": 100.0}, {"nodeid": "b", "elapsed": 2.0}]
+
+def test_results_without_slowest():
+    results = pytest_tracerobot.TraceRobotResults(slowest_count=0)
+    results.add_test("a", [], "passed", 1.0)
+    assert results.slowest == []
+
+class Items(list):
+    pass
+
+class Table:
+    def __init__(self, rows):
+        self.rows = rows
+
+def capture(value, summarizers=None, **options):
+    policy = pytest_tracerobot.ValueCapturePolicy(
+        maxlength=options.get("maxlength", 40),
+        maxitems=options.get("maxitems", 5),
+        enabled=options.get("enabled", True),
+        summarizers=summarizers)
+    return policy.capture(value)
+
+def test_capture_list():
+    assert capture([1, 2]) == "[1, 2]"
+    assert capture(list(range(100))) == "[0, 1, 2, 3, 4, ...]"
+
+def test_capture_list_subclass():
+    assert capture(Items([1, 2])) == "[1, 2]"
+    assert capture(Items(range(100))) == "<Items of length 100>"
+
+def test_capture_large_str():
+    text = capture("x" * 100)
+    assert len(text) == 40
+    assert text.startswith("'xxx") and "..." in text and text.endswith("xx'")
+
+@pytest.mark.parametrize("cls", [bytes, bytearray])
+def test_capture_large_bytes(cls):
+    text = capture(cls(b"\x00" * 100))
+    assert len(text) <= 40
+    assert text.endswith("... (100 bytes)")
+    assert capture(cls(b"abc")) == repr(cls(b"abc"))
+
+def test_capture_summarizer():
+    summarizers = {Table: lambda table: "Table of %d rows" % len(table.rows)}
+    assert capture(Table([1, 2]), summarizers) == "Table of 2 rows"
+
+def test_capture_summarizer_returning_none():
+    assert capture(Table([]), {Table: lambda table: None}) is None
+
+def test_capture_failing_summarizer():
+    def summarize(table):
+        raise RuntimeError("no rows")
+    assert capture(Table(None), {Table: summarize}) == \
+        "<Table: summarizer failed>"
+
+def test_capture_uses_registered_summarizers(monkeypatch):
+    monkeypatch.setitem(pytest_tracerobot.VALUE_SUMMARIZERS, Table,
+        lambda table: "Table")
+    assert capture(Table([])) == "Table"
+
+def test_capture_disabled():
+    plugin = pytest_tracerobot.TraceRobotPlugin(
+        FakeConfig(robot_no_values=True))
+    assert plugin._values.capture([1, 2]) is None
+    assert capture("value", enabled=False) is None
+
+FIXTURE_TESTS = """
+import pytest
+
+@pytest.fixture
+def base():
+    return 1
+
+@pytest.fixture
+def middle(base):
+    return base + 1
+
+@pytest.fixture
+def top(middle):
+    return middle + 1
+
+@pytest.fixture
+def broken():
+    raise RuntimeError("no connection")
+
+@pytest.fixture
+def needs_broken(broken):
+    return broken
+
+@pytest.fixture
+def extra():
+    return 0
+
+@pytest.fixture
+def late(request):
+    return request.getfixturevalue("extra")
+
+def test_nested(top):
+    pass
+
+def test_nested_again(top):
+    pass
+
+def test_late(request, top):
+    request.getfixturevalue("late")
+
+def test_failing_dependency(needs_broken):
+    pass
+"""
+
+@pytest.fixture
+def run_traced(pytester, monkeypatch):
+    """ Run FIXTURE_TESTS in-process with the plugin, and return the
+    keywords traced for each test as indented lines. """
+    calls = []
+    def record(name):
+        def call(*args, **kwargs):
+            calls.append((name, args, kwargs))
+            return len(calls) - 1
+        return call
+    for name in ("tracerobot_init", "close", "start_suite", "end_suite",
+                 "start_test", "end_test", "start_keyword", "end_keyword",
+                 "log_message", "start_auto_trace", "stop_auto_trace",
+                 "set_auto_trace_kwtype"):
+        monkeypatch.setattr(pytest_tracerobot.tracerobot, name, record(name))
+    # the plugin is loaded explicitly, whether installed or not
+    monkeypatch.setenv("PYTEST_DISABLE_PLUGIN_AUTOLOAD", "1")
+    pytester.makepyfile(test_fixtures=FIXTURE_TESTS)
+
+    def run(*args):
+        del calls[:]
+        pytester.runpytest("-p", "pytest_tracerobot", *args)
+
+        tests = {}
+        lines = depth = None
+        keywords = {}
+        for index, (name, args, kwargs) in enumerate(calls):
+            if name == "start_test":
+                lines = tests[kwargs["name"]] = []
+                depth = 0
+            elif name == "start_keyword":
+                keywords[index] = len(lines)
+                lines.append("  " * depth + "%s %s" % (args[1], args[0]))
+                depth += 1
+            elif name == "end_keyword":
+                depth -= 1
+                if kwargs.get("error_msg"):
+                    lines[keywords[args[0]]] += " FAIL"
+            elif name == "log_message" and lines is not None:
+                lines.append("  " * depth + args[0].split("\n")[0])
+        return tests
+
+    return run
+
+def test_flat_fixtures(run_traced):
+    tests = run_traced("--robot-fixtures", "flat")
+
+    assert tests["test_nested"] == [
+        "setup base", "setup middle", "setup top", "teardown fixture(s)"]
+    assert tests["test_late"] == [
+        "setup base", "setup middle", "setup top",
+        "setup late", "  setup extra", "teardown fixture(s)"]
+    assert tests["test_failing_dependency"] == ["setup broken FAIL"]
+
+def test_nested_fixtures(run_traced):
+    tests = run_traced("--robot-fixtures", "tree")
+
+    assert tests["test_nested"] == [
+        "setup top", "  setup middle", "    setup base",
+        "teardown fixture(s)"]
+    assert tests["test_late"] == [
+        "setup top", "  setup middle", "    setup base",
+        "setup late", "  setup extra", "teardown fixture(s)"]
+    assert tests["test_failing_dependency"] == [
+        "setup needs_broken FAIL", "  setup broken FAIL"]
+
+def test_compact_fixtures(run_traced):
+    tests = run_traced("--robot-fixtures", "compact")
+
+    # the first test using the fixtures gets them as a tree
+    assert tests["test_nested"] == [
+        "Fixture graph:", "setup top", "  setup middle", "    setup base",
+        "teardown fixture(s)"]
+    assert tests["test_nested_again"] == [
+        "setup fixture(s)", "  Fixture setup times:", "teardown fixture(s)"]
+    # requested from the test body, after the setup phase
+    assert tests["test_late"] == [
+        "setup fixture(s)", "  Fixture setup times:", "setup late",
+        "  setup extra", "teardown fixture(s)"]
+    assert tests["test_failing_dependency"] == [
+        "Fixture graph:", "setup needs_broken FAIL", "  setup broken FAIL"]
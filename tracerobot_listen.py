@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+""" Reference consumer for the pytest-tracerobot event stream.
+
+Binds a Unix domain socket and prints the currently running test and
+keyword stack as events arrive, followed by per-test durations.
+
+Start the listener first, then run pytest with the same socket path:
+
+    ./tracerobot_listen.py /tmp/tracerobot.sock
+    pytest --robot-events /tmp/tracerobot.sock
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+
+MAX_DATAGRAM = 65536
+
+class ProgressPrinter:
+    def __init__(self, out=sys.stdout):
+        self._out = out
+        self._suites = []
+        self._test = None
+        self._keywords = []
+        self._durations = []
+
+    def _print(self, text):
+        self._out.write(text + "\n")
+        self._out.flush()
+
+    def _print_position(self):
+        parts = ["/".join(self._suites)]
+        if self._test:
+            parts.append(self._test)
+        parts.extend(self._keywords)
+        self._print("  " + " > ".join(parts))
+
+    def handle(self, event):
+        kind = event.get("event")
+
+        if kind == "start_suite":
+            self._suites = list(event["path"])
+        elif kind == "end_suite":
+            self._suites = list(event["path"][:-1])
+        elif kind == "start_test":
+            self._test = event["name"]
+            self._keywords = []
+            self._print_position()
+        elif kind == "end_test":
+            self._print("%s %8.3fs %s" % (
+                event["status"], event["elapsed"], event["nodeid"]))
+            self._durations.append((event["elapsed"], event["nodeid"]))
+            self._test = None
+            self._keywords = []
+        elif kind == "start_keyword":
+            self._keywords.append(event["name"])
+            self._print_position()
+        elif kind == "end_keyword":
+            if self._keywords:
+                self._keywords.pop(-1)
+        elif kind == "end_session":
+            self.print_slowest()
+
+    def print_slowest(self, count=10):
+        if not self._durations:
+            return
+        self._print("Slowest tests:")
+        for elapsed, nodeid in sorted(self._durations, reverse=True)[:count]:
+            self._print("%8.3fs %s" % (elapsed, nodeid))
+        self._durations = []
+
+def listen(path, printer):
+    if os.path.exists(path):
+        os.unlink(path)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    try:
+        while True:
+            data = sock.recv(MAX_DATAGRAM)
+            for line in data.decode("utf-8").splitlines():
+                if line:
+                    printer.handle(json.loads(line))
+    finally:
+        sock.close()
+        os.unlink(path)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Print live progress of a pytest-tracerobot run.")
+    parser.add_argument("socket", help="Unix domain socket path to bind")
+    args = parser.parse_args()
+
+    printer = ProgressPrinter()
+    try:
+        listen(args.socket, printer)
+    except KeyboardInterrupt:
+        printer.print_slowest()
+
+if __name__ == "__main__":
+    main()